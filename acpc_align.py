@@ -11,52 +11,76 @@ PLACE  : Caltech
 import os.path as op
 import ants
 from templateflow import api as tf
+from functools import lru_cache
 import argparse
 
+
+@lru_cache(maxsize=None)
+def get_reference(resolution=1):
+    """
+    Fetch MNI152 2009c nonlin asym T1w brain template filename from TemplateFlow
+    """
+    return tf.get(
+        'MNI152NLin2009cAsym',
+        resolution=resolution,
+        suffix='T1w',
+        desc='brain'
+    )
+
+
 def main():
 
     # Parse command line arguments
     parser = argparse.ArgumentParser(description='AC-PC align structural image')
-    parser.add_argument('-i', '--infile', required=True, help='Unaligned structural image')
+    parser.add_argument('-i', '--infiles', required=True, nargs='+', help='Unaligned structural image(s)')
     parser.add_argument('-r', '--resolution', type=float, default=1.0, help='Output resolution (mm)')
     args = parser.parse_args()
 
-    anat_fname = args.infile
-    assert op.isfile(anat_fname)
+    for anat_fname in args.infiles:
+        assert op.isfile(anat_fname)
 
     # Download MNI152 2009c nonlin asym T1w head template
-    # The affine registration can be done at 2mm since
-    # the extracted rigid body transfer is applied at full resolution
     print('Getting TemplateFlow Reference Image')
-    ref_fname = tf.get(
-        'MNI152NLin2009cAsym',
-        resolution=1,
-        suffix='T1w',
-        desc='brain'
-    )
+    ref_fname = get_reference(resolution=1)
 
-    # Load reference as an AntsImage
+    # Load reference as an AntsImage once for all inputs
     print(f'Loading reference image {ref_fname}')
     ref_ai = ants.image_read(str(ref_fname))
 
-    # Load structural image (whole head)
-    print(f'Loading anatomic image {anat_fname}')
-    anat_ai = ants.image_read(anat_fname)
+    # The affine registration can be done at 2mm since
+    # the extracted rigid body transfer is applied at full resolution
+    print('Downsampling reference image to 2 mm for registration')
+    ref_ai_2mm = ants.resample_image(ref_ai, (2.0, 2.0, 2.0), use_voxels=False, interp_type=4)
 
-    # Rigid body align anatomic to reference image
-    print('Starting rigid registration of anatomic to reference image')
-    res_dict = ants.registration(
-        fixed=ref_ai,
-        moving=anat_ai,
-        type_of_transform='Rigid'
-    )
+    for anat_fname in args.infiles:
+
+        # Load structural image (whole head)
+        print(f'Loading anatomic image {anat_fname}')
+        anat_ai = ants.image_read(anat_fname)
+
+        # Rigid body align anatomic to downsampled reference image
+        print('Starting rigid registration of anatomic to reference image')
+        res_dict = ants.registration(
+            fixed=ref_ai_2mm,
+            moving=anat_ai,
+            type_of_transform='Rigid'
+        )
+
+        # Spline resample anatomic to full resolution reference space
+        print('Applying rigid transform at reference resolution')
+        anat_acpc_ai = ants.apply_transforms(
+            fixed=ref_ai,
+            moving=anat_ai,
+            transformlist=res_dict['fwdtransforms'],
+            interpolator='bSpline'
+        )
 
-    # TODO: Implement arbitrary output spatial resolution from CLI
+        # TODO: Implement arbitrary output spatial resolution from CLI
 
-    # Save AC-PC aligned image to same folder as original anatomic image
-    anat_acpc_fname = anat_fname.replace('.nii.gz', '_acpc.nii.gz')
-    print(f'Saving ACPC aligned image to {anat_acpc_fname}')
-    res_dict['warpedmovout'].to_file(anat_acpc_fname)
+        # Save AC-PC aligned image to same folder as original anatomic image
+        anat_acpc_fname = anat_fname.replace('.nii.gz', '_acpc.nii.gz')
+        print(f'Saving ACPC aligned image to {anat_acpc_fname}')
+        anat_acpc_ai.to_file(anat_acpc_fname)
 
 
 if "__main__" in __name__:
@@ -38,10 +38,13 @@ __version__ = '0.1.0'
 
 import os
 import argparse
-import pandas as pd
 import numpy as np
 
 
+# Degrees to radians conversion factor
+DEG2RAD = np.float64(np.pi / 180.0)
+
+
 def main():
 
     # Parse command line arguments
@@ -66,20 +69,9 @@ def main():
     # So for RAS orientation, the file columns map to:
     # roll, pitch, yaw, dS, dL, dP : Rz, Rx, Ry, dz, dx, dy
 
-    p = pd.read_csv(args.infile,
-                   header=None,
-                   delim_whitespace=True,
-                   names=["rz_deg", "rx_deg", "ry_deg", "tz_mm", "tx_mm", "ty_mm"])
-
-    # Extract translations
-    tx_mm = p["tx_mm"]
-    ty_mm = p["ty_mm"]
-    tz_mm = p["tz_mm"]
-
-    # Convert degrees to radians
-    rx_rad = p["rx_deg"] * np.pi / 180.0
-    ry_rad = p["ry_deg"] * np.pi / 180.0
-    rz_rad = p["rz_deg"] * np.pi / 180.0
+    # Load all six columns into a single contiguous (N, 6) float64 array
+    cols = ["rz_deg", "rx_deg", "ry_deg", "tz_mm", "tx_mm", "ty_mm"]
+    p = np.loadtxt(args.infile, dtype=np.float64, ndmin=2)
 
     # Use the FD definition from Power JD et al Neuroimage 2012;59:2142
     # http://dx.doi.org/10.1016/j.neuroimage.2011.10.018
@@ -95,18 +87,16 @@ def main():
     # of a sphere of radius 50 mm, which is approximately the mean distance from the cerebral cortex to the center of
     # the head.
 
-    # Backward differences (forward difference array with leading 0)
-    drx = np.insert(np.diff(rx_rad), 0, 0)
-    dry = np.insert(np.diff(ry_rad), 0, 0)
-    drz = np.insert(np.diff(rz_rad), 0, 0)
-    dtx = np.insert(np.diff(tx_mm), 0, 0)
-    dty = np.insert(np.diff(ty_mm), 0, 0)
-    dtz = np.insert(np.diff(tz_mm), 0, 0)
-
-    # Total framewise displacement (Power 2012)
+    # Convert rotations (first three columns) from degrees to mm of arc on the sphere
+    # in a single broadcast multiply, leaving the raw parameters untouched for output
     r_sphere = 50.0  # mm
-    FD = (np.abs(dtx) + np.abs(dty) + np.abs(dtz) +
-          np.abs(r_sphere * drx) + np.abs(r_sphere * dry) + np.abs(r_sphere * drz))
+    scale = np.array([DEG2RAD * r_sphere] * 3 + [1.0] * 3)
+    arr = p * scale
+
+    # Backward differences (leading row of zeros) summed over all six parameters (Power 2012)
+    d = np.diff(arr, axis=0, prepend=arr[:1, :])
+    np.abs(d, out=d)
+    FD = d.sum(axis=1)
 
     # Report FD stats in mm
     print('')
@@ -117,13 +107,11 @@ def main():
     print('  Min    : {:0.3f} mm'.format(np.min(FD)))
     print('  Max    : {:0.3f} mm'.format(np.max(FD)))
 
-    # Add FD to dataframe
-    p["FD_mm"] = FD
-
-    # Save dataframe to CSV file
+    # Save parameters and FD to CSV file
     outfile = args.infile.replace('.1D', '_FD.csv')
     print('Saving results to {}'.format(os.path.basename(outfile)))
-    p.to_csv(outfile, header=True, float_format='%0.6f', index=False)
+    np.savetxt(outfile, np.column_stack([p, FD]),
+               fmt='%0.6f', delimiter=',', header=','.join(cols + ['FD_mm']), comments='')
 
 
 # This is the standard boilerplate that calls the main() function.
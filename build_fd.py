@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+"""
+Ahead-of-time compile the FD kernels in spm_realign_FD.py to the spm_fd_kernels extension module
+- Requires Numba (numba.pycc, pending deprecation since 0.57) and a C compiler at build time only
+- Embeds kernel_id() so that spm_realign_FD.py ignores the module once the kernels change
+
+AUTHOR : Mike Tyszka
+PLACE  : Caltech
+"""
+
+__version__ = '0.1.0'
+
+
+import os
+from numba.pycc import CC
+from spm_realign_FD import _compute_fd, _fd_stats, kernel_id, COMPUTE_FD_SIG, FD_STATS_SIG
+
+
+def main():
+
+    # Export the pure Python kernels from spm_realign_FD with the same signatures as the JIT versions
+    cc = CC('spm_fd_kernels')
+    cc.output_dir = os.path.dirname(os.path.realpath(__file__))
+    cc.export('compute_fd', COMPUTE_FD_SIG)(_compute_fd)
+    cc.export('fd_stats', FD_STATS_SIG)(_fd_stats)
+
+    # Numba freezes the closure variable as a compile-time constant
+    kid = kernel_id()
+
+    def _kernel_id():
+        return kid
+
+    cc.export('kernel_id', 'i8()')(_kernel_id)
+
+    print('Compiling spm_fd_kernels to {}'.format(cc.output_dir))
+    cc.compile()
+
+
+# This is the standard boilerplate that calls the main() function.
+if __name__ == '__main__':
+    main()
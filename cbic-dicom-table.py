@@ -36,41 +36,76 @@ SOFTWARE.
 __version__ = '0.1.0'
 
 import os
-import pandas as pd
+import sys
+import csv
 import pydicom
 import argparse
-from glob import glob
+from concurrent.futures import ProcessPoolExecutor
+
+
+# Header tags reported for each DICOM image
+TAGS = ['PatientName', 'ProtocolName', 'AcquisitionDate', 'SeriesNumber',
+        'RepetitionTime', 'EchoTime', 'SliceThickness']
+
+
+def iter_dcm(dcm_dir):
+    """
+    Yield paths of DICOM files (*.dcm) in a directory as they are discovered
+    """
+
+    with os.scandir(dcm_dir) as it:
+        for entry in it:
+            # Match glob('*.dcm') semantics, which skips hidden files
+            if entry.name.endswith('.dcm') and not entry.name.startswith('.') and entry.is_file():
+                yield entry.path
+
+
+def read_one(fpath):
+    """
+    Read key header tags from a single DICOM file
+    - Pixel data is skipped and parsing stops once the requested tags are found
+    """
+
+    ds = pydicom.dcmread(fpath, stop_before_pixels=True, specific_tags=TAGS)
+
+    return (
+        os.path.basename(fpath),
+        str(ds.PatientName),
+        str(ds.ProtocolName),
+        str(ds.AcquisitionDate),
+        int(ds.SeriesNumber),
+        float(ds.RepetitionTime),
+        float(ds.EchoTime),
+        float(ds.SliceThickness)
+    )
+
 
 def main():
 
     # Parse command line arguments
     parser = argparse.ArgumentParser(description="Create header tag table from DICOM folder")
     parser.add_argument('-d', '--dicomdir', required=False, default='.', help="DICOM image folder ['.']")
+    parser.add_argument('-o', '--outfile', required=False, help="Optional CSV output file")
 
     # Parse command line arguments
     args = parser.parse_args()
 
     dcm_dir = os.path.realpath(args.dicomdir)
-    dcm_list = glob(os.path.join(dcm_dir, '*.dcm'))
-
-    for fpath in dcm_list:
-
-        fname = os.path.basename(fpath)
-
-        ds = pydicom.dcmread(fname)
-
-        print(
-            '{:s} | {:s} | {:s} | {:s} | {:d} | {:8.1f} {:8.3f} {:4.1f}'.format(
-                fname,
-                str(ds.PatientName),
-                str(ds.ProtocolName),
-                str(ds.AcquisitionDate),
-                int(ds.SeriesNumber),
-                float(ds.RepetitionTime),
-                float(ds.EchoTime),
-                float(ds.SliceThickness)
-            )
-        )
+
+    # Read headers in parallel, one file per task, streaming files from directory scan
+    with ProcessPoolExecutor() as ex:
+        rows = list(ex.map(read_one, iter_dcm(dcm_dir), chunksize=64))
+
+    # Format table and write to stdout in a single call
+    fmt = '{:s} | {:s} | {:s} | {:s} | {:d} | {:8.1f} {:8.3f} {:4.1f}\n'
+    sys.stdout.write(''.join(fmt.format(*row) for row in rows))
+
+    if args.outfile:
+        print('Saving table to {}'.format(args.outfile), file=sys.stderr)
+        with open(args.outfile, 'w', newline='') as fd:
+            writer = csv.writer(fd)
+            writer.writerow(['Filename'] + TAGS)
+            writer.writerows(rows)
 
 # This is the standard boilerplate that calls the main() function.
 if __name__ == '__main__':
@@ -38,7 +38,104 @@ __version__ = '0.1.0'
 import nibabel as nb
 import numpy as np
 from skimage.restoration import unwrap_phase
-from scipy.signal import medfilt
+from scipy.ndimage import median_filter
+
+try:
+    from numba import njit, prange
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+
+def _oddeven_merge(lo, hi, r):
+    step = r * 2
+    if step < hi - lo:
+        yield from _oddeven_merge(lo, hi, step)
+        yield from _oddeven_merge(lo + r, hi, step)
+        yield from [(i, i + r) for i in range(lo + r, hi - r, step)]
+    else:
+        yield (lo, lo + r)
+
+
+def _oddeven_merge_sort(lo, hi):
+    if (hi - lo) >= 1:
+        mid = lo + ((hi - lo) // 2)
+        yield from _oddeven_merge_sort(lo, mid)
+        yield from _oddeven_merge_sort(mid + 1, hi)
+        yield from _oddeven_merge(lo, hi, 1)
+
+
+def sort_network(n):
+    """
+    Comparator pairs for a Batcher odd-even merge sorting network on n elements
+
+    The network is built for the next power of two and comparators touching the
+    (notionally +inf) padding elements are dropped since they never swap.
+    """
+    n2 = 1 << (n - 1).bit_length()
+    pairs = [(i, j) for i, j in _oddeven_merge_sort(0, n2 - 1) if j < n]
+    return np.array(pairs, dtype=np.int64)
+
+
+if HAVE_NUMBA:
+
+    @njit(parallel=True, fastmath=True, boundscheck=False, cache=True)
+    def median3d_masked(vol, mask, pairs, out):
+        """
+        Masked 3x3x3 median filter using a fixed sorting network
+
+        Neighbours outside the volume are treated as 0.0 (zero padding, as scipy.signal.medfilt
+        and scipy.ndimage.median_filter with mode='constant'). Voxels outside the mask are set to zero.
+        """
+        nx, ny, nz = vol.shape
+
+        for x in prange(nx):
+
+            buf = np.empty(27, dtype=vol.dtype)
+
+            for y in range(ny):
+                for z in range(nz):
+
+                    if not mask[x, y, z]:
+                        out[x, y, z] = 0.0
+                        continue
+
+                    # Gather zero-padded 3x3x3 neighbourhood
+                    n = 0
+                    for i in range(x - 1, x + 2):
+                        for j in range(y - 1, y + 2):
+                            for k in range(z - 1, z + 2):
+                                if 0 <= i < nx and 0 <= j < ny and 0 <= k < nz:
+                                    buf[n] = vol[i, j, k]
+                                else:
+                                    buf[n] = 0.0
+                                n += 1
+
+                    # Branch-free compare-exchange through the network
+                    for p in range(pairs.shape[0]):
+                        a = buf[pairs[p, 0]]
+                        b = buf[pairs[p, 1]]
+                        buf[pairs[p, 0]] = min(a, b)
+                        buf[pairs[p, 1]] = max(a, b)
+
+                    out[x, y, z] = buf[13]
+
+
+def median_filter_masked(vol, mask):
+    """
+    3x3x3 zero-padded median filter of vol within a boolean mask, zero elsewhere
+    - Uses the Numba sorting network kernel if available, otherwise scipy.ndimage
+    """
+
+    out = np.empty_like(vol)
+
+    if HAVE_NUMBA:
+        median3d_masked(vol, mask, sort_network(27), out)
+    else:
+        median_filter(vol, size=3, output=out, mode='constant')
+        np.copyto(out, 0.0, where=~mask)
+
+    return out
 
 
 def main():
@@ -49,11 +146,11 @@ def main():
 
     print('Loading magnitude images')
     mag_nii = nb.load(mag_fname)
-    mag = mag_nii.get_data()
+    mag = np.asarray(mag_nii.dataobj, dtype=np.float32)
 
     print('Loading phase images')
     phs_nii = nb.load(phs_fname)
-    phs = phs_nii.get_data()
+    phs = np.asarray(phs_nii.dataobj, dtype=np.float32)
 
     # TEs in seconds
     print('Loading TEs')
@@ -64,39 +161,55 @@ def main():
 
     # Create signal mask from 10% threshold of first echo magnitude
     mag_0 = mag[:, :, :, 0]
-    th = np.max(mag_0) * 0.1
-    mask = (mag_0 > th).astype(float)
+    th = np.float32(np.max(mag_0) * 0.1)
+    mask = mag_0 > th
+
+    # Background (outside mask) for in-place zeroing with np.copyto
+    bg = ~mask
 
     # Echo time difference (s)
-    dTE = te[1] - te[0]
+    # Kept as float32 so that downstream arithmetic is not promoted to float64
+    dTE = np.float32(te[1] - te[0])
 
     # Estimate T2* (exponential model) with mask
-    T2star_ms = dTE * 1e3 / (np.log((mag[:, :, :, 0] / mag[:, :, :, 1]))) * mask
+    # T2* = dTE / (log(S1) - log(S2)), evaluated only where both logs and the ratio are defined
+    # Voxels outside the mask or with zero signal/decay are left at 0.0
+    mag_1 = mag[:, :, :, 1]
+    valid = mask & (mag_1 > 0)
+    T2star_ms = np.zeros_like(mag_0)
+    log_1 = np.zeros_like(mag_0)
+    np.log(mag_0, out=T2star_ms, where=valid)
+    np.log(mag_1, out=log_1, where=valid)
+    np.subtract(T2star_ms, log_1, out=T2star_ms)
+    valid &= T2star_ms != 0
+    np.divide(dTE * 1e3, T2star_ms, out=T2star_ms, where=valid)
+    del log_1, valid
 
     # Scale phase from [-4096, 4096] to [-pi, pi]
-    phs = phs * np.pi / 4096.0
+    phs *= np.float32(np.pi / 4096.0)
 
     # Phase difference between second and first echoes
     print('phi(TE2) - phi(TE1)')
     dphi = phs[:, :, :, 1] - phs[:, :, :, 0]
 
     print('Unwrapping phase')
-    dphi = unwrap_phase(dphi)
+    dphi = unwrap_phase(dphi).astype(np.float32, copy=False)
 
-    # 3x3 median filter masked phase difference
+    # 3x3x3 median filter masked phase difference
     print('Median filtering phase difference')
-    dphi = medfilt(dphi, 3) * mask
+    dphi = median_filter_masked(dphi, mask)
 
     # Set median phase difference within mask to 0.0
     print('Setting median phase difference to 0.0 within mask')
-    dphi_med = np.median(dphi[mask.astype(bool)])
+    dphi_med = np.median(dphi[mask])
     dphi -= dphi_med
 
     # Field offset in rad/s with mask
-    dB0_rad_s = dphi / dTE * mask
+    dB0_rad_s = np.multiply(dphi, 1.0 / dTE)
+    np.copyto(dB0_rad_s, 0.0, where=bg)
 
     # Field offset in Hz with mask
-    dB0_Hz = dB0_rad_s / (2.0 * np.pi)
+    dB0_Hz = np.multiply(dB0_rad_s, 1.0 / (2.0 * np.pi))
 
     # Voxel dimensions in m
     dx = np.abs(T[0, 0]) / 1e3
@@ -106,15 +219,14 @@ def main():
     # grad(dB0) in mT/m
     print('Field gradient in mT/m')
     gamma_1H = 42.58e3  # Hz/mT
+    inv_gamma = 1.0 / gamma_1H
     gx, gy, gz = np.gradient(dB0_Hz, dx, dy, dz)
 
-    # Scale from Hz/m to mT/m and mask
-    gx *= mask/gamma_1H
-    gy *= mask/gamma_1H
-    gz *= mask/gamma_1H
-
-    # Stack field gradient in 4D array
-    grad_dB0 = np.stack([gx, gy, gz], axis=3)
+    # Scale from Hz/m to mT/m and mask, writing directly into the 4D output
+    grad_dB0 = np.empty(dB0_Hz.shape + (3,), dtype=np.float32)
+    for k, g in enumerate([gx, gy, gz]):
+        np.multiply(g, inv_gamma, out=grad_dB0[..., k])
+        np.copyto(grad_dB0[..., k], 0.0, where=bg)
 
     #
     # Save results
@@ -141,7 +253,7 @@ def main():
     T2star_ms_nii.to_filename('T2star_ms.nii.gz')
 
     print('Saving signal mask')
-    mask_nii = nb.Nifti1Image(mask, T)
+    mask_nii = nb.Nifti1Image(mask.astype(np.uint8), T)
     mask_nii.to_filename('mask.nii.gz')
 
 
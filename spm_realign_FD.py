@@ -37,37 +37,182 @@ __version__ = '0.1.0'
 
 
 import os
+import sys
+import inspect
+import hashlib
 import argparse
-import pandas as pd
 import numpy as np
+from glob import glob
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+# Kernel signatures shared by the JIT (below) and AOT (build_fd.py) compiled versions
+COMPUTE_FD_SIG = 'float32[:](float32[:, :], float32)'
+FD_STATS_SIG = 'UniTuple(float64, 4)(float32[:])'
 
-def main():
+try:
+    import numexpr as ne
+    HAVE_NUMEXPR = True
+except ImportError:
+    HAVE_NUMEXPR = False
 
-    # Parse command line arguments
-    parser = argparse.ArgumentParser(description="Compute FD statistics from SPM realignment parameters")
-    parser.add_argument('-i', '--infile', required=True, help="SPM six-column realignment parameter file")
 
-    # Parse command line arguments
-    args = parser.parse_args()
+def _compute_fd(data, r_sphere):
+    """
+    Fused framewise displacement kernel
+
+    data     : (N, 6) array of tx, ty, tz (mm) and rx, ry, rz (rad)
+    r_sphere : head sphere radius (mm) for rotation to displacement conversion
+    """
+
+    N = data.shape[0]
+    FD = np.empty(N, dtype=np.float32)
+    FD[0] = 0.0
+
+    for i in range(1, N):
+        dtx = data[i, 0] - data[i - 1, 0]
+        dty = data[i, 1] - data[i - 1, 1]
+        dtz = data[i, 2] - data[i - 1, 2]
+        drx = data[i, 3] - data[i - 1, 3]
+        dry = data[i, 4] - data[i - 1, 4]
+        drz = data[i, 5] - data[i - 1, 5]
+        FD[i] = abs(dtx) + abs(dty) + abs(dtz) + r_sphere * (abs(drx) + abs(dry) + abs(drz))
+
+    return FD
+
+
+def _fd_stats(FD):
+    """
+    Single-pass mean, SD (population), min and max using Welford's algorithm
+    """
+
+    n = FD.shape[0]
+    mean = 0.0
+    m2 = 0.0
+    fd_min = FD[0]
+    fd_max = FD[0]
+
+    for i in range(n):
+        x = FD[i]
+        if x < fd_min:
+            fd_min = x
+        if x > fd_max:
+            fd_max = x
+        delta = x - mean
+        mean += delta / (i + 1)
+        m2 += delta * (x - mean)
+
+    return mean, (m2 / n) ** 0.5, fd_min, fd_max
+
+
+def kernel_id():
+    """
+    Hash of the kernel sources and signatures, embedded in spm_fd_kernels by build_fd.py
+    """
+
+    src = ''.join([inspect.getsource(_compute_fd), inspect.getsource(_fd_stats), COMPUTE_FD_SIG, FD_STATS_SIG])
+
+    # Truncate to 60 bits so the ID fits the int64 return type of the exported kernel
+    return int(hashlib.sha1(src.encode('utf-8')).hexdigest()[:15], 16)
+
+
+@lru_cache(maxsize=None)
+def get_aot_kernels():
+    """
+    Ahead-of-time compiled (compute_fd, fd_stats) kernels built by build_fd.py,
+    or None if spm_fd_kernels is missing or was built from different kernel sources
+    """
+
+    try:
+        import spm_fd_kernels
+    except ImportError:
+        return None
+
+    if not hasattr(spm_fd_kernels, 'kernel_id') or spm_fd_kernels.kernel_id() != kernel_id():
+        print('* spm_fd_kernels does not match the kernels in spm_realign_FD.py - ignoring (rerun build_fd.py)',
+              file=sys.stderr)
+        return None
+
+    return spm_fd_kernels.compute_fd, spm_fd_kernels.fd_stats
+
+
+@lru_cache(maxsize=None)
+def get_jit_kernels():
+    """
+    Compile (or load from the __pycache__ cache) the Numba JIT kernels on first use
+    - numba is only imported here, so short series and build_fd.py never pay its load cost
+    - Returns (compute_fd, fd_stats), or None if numba is not installed
+    """
+
+    try:
+        from numba import njit
+    except ImportError:
+        return None
+
+    return (njit(COMPUTE_FD_SIG, cache=True, fastmath=True)(_compute_fd),
+            njit(FD_STATS_SIG, cache=True, fastmath=True)(_fd_stats))
+
+# Minimum number of volumes for which the Numba JIT kernels beat the NumPy/numexpr path
+# Loading even the cached JIT kernels costs ~0.8 s per process, while the in-place NumPy
+# path computes FD for 5000 volumes in well under a millisecond, so JIT only pays off for
+# extremely long (concatenated) series
+NUMBA_MIN_ROWS = 10_000_000
+
+
+def get_kernels(n_rows):
+    """
+    Compiled (compute_fd, fd_stats) kernels for a series of n_rows volumes,
+    or None if the NumPy/numexpr path should be used
+    """
+
+    # AOT kernels have no load cost, JIT kernels are only worthwhile for very long series
+    aot_kernels = get_aot_kernels()
+    if aot_kernels is not None:
+        return aot_kernels
+
+    if n_rows > NUMBA_MIN_ROWS:
+        return get_jit_kernels()
+
+    return None
+
+
+def load_params(fname, n_cols=6):
+    """
+    Load whitespace-delimited realignment parameters as an (N, n_cols) float64 array
+    - np.loadtxt (C parser) keeps the row structure, so ragged or corrupted files raise ValueError
+    """
+
+    p = np.loadtxt(fname, dtype=np.float64, ndmin=2)
+
+    if p.shape[1] != n_cols:
+        raise ValueError('{} does not contain {} columns per row'.format(fname, n_cols))
+
+    return p
+
+
+def process_one_file(infile):
+    """
+    Compute FD for a single SPM realignment parameter file and save results to CSV
+    - Returns the FD statistics report as a string so that parallel workers do not interleave output
+    """
+
+    # Refuse to overwrite an input that does not end in .txt (eg rp_10.par)
+    outfile = infile.replace('.txt', '_FD.csv')
+    if outfile == infile:
+        raise ValueError('output filename would overwrite input')
 
     # Read SPM realign parameters
     # Expects 6-column, space-separated values, one row per TR
     # Column order: dx, dy, dz, rx, ry, rz
     # Displacements in mm, rotations in radians
 
-    p = pd.read_csv(args.infile,
-                   header=None,
-                   delim_whitespace=True,
-                   names=["tx_mm", "ty_mm", "tz_mm", "rx_rad", "ry_rad", "rz_rad"])
+    cols = ["tx_mm", "ty_mm", "tz_mm", "rx_rad", "ry_rad", "rz_rad"]
+    # Parameters are parsed and written back to the CSV (%0.6f) at full float64 precision
+    p = load_params(infile)
 
-    # Extract translations and rotations
-    tx_mm = p["tx_mm"]
-    ty_mm = p["ty_mm"]
-    tz_mm = p["tz_mm"]
-    rx_rad = p["rx_rad"]
-    ry_rad = p["ry_rad"]
-    rz_rad = p["rz_rad"]
+    # FD itself is computed in float32, which is ample for the %0.3f FD statistics
+    # but can change the 6th decimal of FD_mm relative to a float64 computation
+    p_f32 = np.ascontiguousarray(p, dtype=np.float32)
 
     # Use the FD definition from Power JD et al Neuroimage 2012;59:2142
     # http://dx.doi.org/10.1016/j.neuroimage.2011.10.018
@@ -83,35 +228,129 @@ def main():
     # of a sphere of radius 50 mm, which is approximately the mean distance from the cerebral cortex to the center of
     # the head.
 
-    # Backward differences (forward difference array with leading 0)
-    drx = np.insert(np.diff(rx_rad), 0, 0)
-    dry = np.insert(np.diff(ry_rad), 0, 0)
-    drz = np.insert(np.diff(rz_rad), 0, 0)
-    dtx = np.insert(np.diff(tx_mm), 0, 0)
-    dty = np.insert(np.diff(ty_mm), 0, 0)
-    dtz = np.insert(np.diff(tz_mm), 0, 0)
+    r_sphere = np.float32(50.0)  # mm
+
+    n_vols = p.shape[0]
+    kernels = get_kernels(n_vols)
+
+    if kernels is not None:
+
+        compute_fd, fd_stats = kernels
+
+        # Total framewise displacement (Power 2012) in a single fused pass
+        # The AOT kernels do no type checking, so p_f32 and r_sphere must match COMPUTE_FD_SIG exactly
+        FD = compute_fd(p_f32, r_sphere)
 
-    # Total framewise displacement (Power 2012)
-    r_sphere = 50.0  # mm
-    FD = (np.abs(dtx) + np.abs(dty) + np.abs(dtz) +
-          np.abs(r_sphere * drx) + np.abs(r_sphere * dry) + np.abs(r_sphere * drz))
+    else:
+
+        # Backward differences of all six parameters into a preallocated buffer
+        buf = np.empty((n_vols - 1, 6), dtype=np.float32)
+        np.subtract(p_f32[1:], p_f32[:-1], out=buf)
+
+        # Total framewise displacement (Power 2012) with leading 0
+        FD = np.empty(n_vols, dtype=np.float32)
+        FD[0] = 0.0
+
+        if HAVE_NUMEXPR:
+
+            # Single fused, threaded numexpr kernel
+            ne.evaluate(
+                'abs(dtx) + abs(dty) + abs(dtz) + r_sphere * (abs(drx) + abs(dry) + abs(drz))',
+                local_dict={
+                    'dtx': buf[:, 0], 'dty': buf[:, 1], 'dtz': buf[:, 2],
+                    'drx': buf[:, 3], 'dry': buf[:, 4], 'drz': buf[:, 5],
+                    'r_sphere': r_sphere
+                },
+                out=FD[1:]
+            )
+
+        else:
+
+            # Convert rotations to displacement on the sphere surface and sum
+            np.abs(buf, out=buf)
+            buf[:, 3:] *= r_sphere
+            np.sum(buf, axis=1, out=FD[1:])
+
+    # FD summary stats (median needs a separate partition)
+    if kernels is not None:
+        fd_mean, fd_sd, fd_min, fd_max = fd_stats(FD)
+    else:
+        fd_mean, fd_sd, fd_min, fd_max = np.mean(FD), np.std(FD), np.min(FD), np.max(FD)
+    fd_median = np.median(FD)
 
     # Report FD stats in mm
-    print('')
-    print('Framewise Displacement Statistics for {}'.format(args.infile))
-    print('  Mean   : {:0.3f} mm'.format(np.mean(FD)))
-    print('  Median : {:0.3f} mm'.format(np.median(FD)))
-    print('  SD     : {:0.3f} mm'.format(np.std(FD)))
-    print('  Min    : {:0.3f} mm'.format(np.min(FD)))
-    print('  Max    : {:0.3f} mm'.format(np.max(FD)))
-
-    # Add FD to dataframe
-    p["FD_mm"] = FD
-
-    # Save dataframe to CSV file
-    outfile = args.infile.replace('.txt', '_FD.csv')
-    print('* Saving results to {}'.format(os.path.basename(outfile)))
-    p.to_csv(outfile, header=True, float_format='%0.6f', index=False)
+    report = [
+        '',
+        'Framewise Displacement Statistics for {}'.format(infile),
+        '  Mean   : {:0.3f} mm'.format(fd_mean),
+        '  Median : {:0.3f} mm'.format(fd_median),
+        '  SD     : {:0.3f} mm'.format(fd_sd),
+        '  Min    : {:0.3f} mm'.format(fd_min),
+        '  Max    : {:0.3f} mm'.format(fd_max),
+    ]
+
+    # Save parameters and FD to CSV file
+    report.append('* Saving results to {}'.format(os.path.basename(outfile)))
+    np.savetxt(outfile, np.column_stack([p, FD]),
+               fmt='%0.6f', delimiter=',', header=','.join(cols + ['FD_mm']), comments='')
+
+    return '\n'.join(report)
+
+
+def main():
+
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description="Compute FD statistics from SPM realignment parameters")
+    parser.add_argument('-i', '--infiles',
+                        required=True,
+                        nargs='+',
+                        help="SPM six-column realignment parameter file(s) or wildcard patterns")
+
+    # Parse command line arguments
+    args = parser.parse_args()
+
+    # Expand wildcards with glob, skipping FD results from earlier runs (rp_* also matches rp_*_FD.csv)
+    infiles = []
+    for pattern in args.infiles:
+        matches = sorted(glob(pattern))
+        if not matches:
+            print('* {} not found - skipping'.format(pattern))
+        for fname in matches:
+            if fname.endswith('_FD.csv'):
+                print('* {} is an FD results file - skipping'.format(fname))
+            else:
+                infiles.append(fname)
+
+    if not infiles:
+        print('* No realignment parameter files found - exiting')
+        sys.exit(1)
+
+    n_failed = 0
+
+    if len(infiles) > 1:
+
+        # Each file is independent, so process in parallel across cores
+        # and print each report as soon as its file is done
+        with ProcessPoolExecutor() as ex:
+            futures = {ex.submit(process_one_file, fname): fname for fname in infiles}
+            for future in as_completed(futures):
+                try:
+                    print(future.result(), flush=True)
+                except Exception as err:
+                    print('* Problem processing {} - {}'.format(futures[future], err), flush=True)
+                    n_failed += 1
+
+    else:
+
+        try:
+            print(process_one_file(infiles[0]))
+        except Exception as err:
+            print('* Problem processing {} - {}'.format(infiles[0], err))
+            n_failed += 1
+
+    if n_failed > 0:
+        print('* {} of {} files could not be processed'.format(n_failed, len(infiles)))
+        sys.exit(1)
 
 
 # This is the standard boilerplate that calls the main() function.